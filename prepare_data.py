@@ -15,4 +15,5 @@ preparer = Preparer(data_path, tokenizer, tokenized_dir)
 
 preparer.tokenize(instance_type='question')
 preparer.tokenize(instance_type='context')
-preparer.get_answer_span()
\ No newline at end of file
+preparer.get_answer_span()
+preparer.compile_mmap()
\ No newline at end of file
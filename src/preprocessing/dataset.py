@@ -1,4 +1,8 @@
 import os
+import shutil
+import warnings
+import weakref
+from multiprocessing import shared_memory
 from typing import List, Optional, Tuple, Union
 
 import numpy as np
@@ -7,7 +11,90 @@ import torch
 from tqdm import tqdm
 
 from src.libs.utils import read_json, read_pickle
-from src.preprocessing.utils import calculate_overlap, resample
+from src.preprocessing.utils import (
+    TOKEN_DTYPES,
+    pack_instances,
+    read_instances,
+    resample,
+)
+
+
+class PackedStorage:
+    """Locations of packed arrays: memory-mapped .npy files or shared memory blocks. Only the locations are
+    pickled, so copies of a dataset (e.g. in DataLoader workers) attach to the same storage, and only the
+    storage that created a shared memory block unlinks it.
+    """
+
+    def __init__(self):
+        """Init."""
+
+        # maps instance type to a dictionary mapping array name to either the path of its .npy file, or
+        # (shared memory name, shape, dtype).
+        self.sources: dict = {}
+        self.blocks: List[shared_memory.SharedMemory] = []
+
+    def __getstate__(self) -> dict:
+        """Gets state for pickling, leaving out the attached shared memory blocks.
+
+        Returns:
+            dict: State.
+        """
+
+        return {"sources": self.sources, "blocks": []}
+
+    def attach(self, instance_type: str) -> dict:
+        """Attaches to the packed arrays of an instance type.
+
+        Args:
+            instance_type (str): Instance type. Either "question" or "context".
+
+        Returns:
+            dict: Arrays.
+        """
+
+        arrays = {}
+        for k, source in self.sources[instance_type].items():
+            if isinstance(source, str):
+                arrays[k] = np.load(source, mmap_mode="r")
+            else:
+                name, shape, dtype = source
+                shm = shared_memory.SharedMemory(name=name)
+                self.blocks.append(shm)
+                arrays[k] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+        return arrays
+
+    def share(
+        self,
+        instance_type: str,
+        k: str,
+        array: np.ndarray,
+        shm: shared_memory.SharedMemory,
+    ) -> np.ndarray:
+        """Copies an array into a newly created shared memory block, which is unlinked when this storage is
+        garbage collected or the interpreter exits, whichever comes first.
+
+        Args:
+            instance_type (str): Instance type. Either "question" or "context".
+            k (str): Array name.
+            array (np.ndarray): Array.
+            shm (shared_memory.SharedMemory): Shared memory block, at least as large as the array.
+
+        Returns:
+            np.ndarray: Array backed by the shared memory block.
+        """
+
+        self.blocks.append(shm)
+        weakref.finalize(self, shm.unlink)
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        shared[:] = array
+        self.sources.setdefault(instance_type, {})[k] = (
+            shm.name,
+            array.shape,
+            array.dtype.str,
+        )
+
+        return shared
 
 
 class Dataset(torch.utils.data.Dataset):
@@ -29,7 +116,9 @@ class Dataset(torch.utils.data.Dataset):
             max_length (int): Maximum length of each sample (Check Hugging Face's Tokenizer class for more detail).
             stride (int): Stride length (Check Hugging Face's Tokenizer class for more detail).
             min_answer_length (int): Minimum answer length to consider including that answer.
-            save_to_memory (bool, optional): Whether to save the whole data to memory or not. Defaults to True.
+            save_to_memory (bool, optional): Whether to save the whole data to memory or not. Ignored when the
+                data has been compiled with Preparer.compile_mmap, in which case it is memory-mapped.
+                Defaults to True.
             selected_questions (Optional[List[str]], optional): Selected questions.
                 If not provided, will be sampling from all questions.
                 Defaults to None.
@@ -41,41 +130,80 @@ class Dataset(torch.utils.data.Dataset):
         self.min_answer_length = min_answer_length
         self.save_to_memory = save_to_memory
 
-        self.content = None
-        if self.save_to_memory:
-            contexts = {
-                os.path.splitext(f)[0]: read_pickle(f"{tokenized_dir}/context/{f}")
-                for f in tqdm(
-                    os.listdir(f"{tokenized_dir}/context"), desc="loading contexts"
-                )
+        self._packed = None
+        self._storage = PackedStorage()
+        if all(
+            os.path.exists(f"{tokenized_dir}/{instance_type}s.index.npy")
+            for instance_type in ["question", "context"]
+        ):
+            self._packed = {
+                instance_type: self._load_packed(instance_type)
+                for instance_type in ["question", "context"]
             }
-            questions = {
-                os.path.splitext(f)[0]: read_pickle(f"{tokenized_dir}/question/{f}")
-                for f in tqdm(
-                    os.listdir(f"{tokenized_dir}/question"), desc="loading questions"
-                )
+        elif self.save_to_memory:
+            self._packed = {
+                instance_type: self._pack(instance_type)
+                for instance_type in ["question", "context"]
             }
-            self.content = {"context": contexts, "question": questions}
 
         self.tokenizer_info = read_json(f"{tokenized_dir}/tokenizer_info.json")
-        self.answers_span = pd.read_csv(f"{tokenized_dir}/answers_span.csv")
+
+        seperators = self.tokenizer_info["seperators"]
+        # tokens left for the question and the sub-context after the separators.
+        self._max_qc_length = self.max_length - sum(sep >= 0 for sep in seperators)
+
+        question_pos, context_pos = [i for i, sep in enumerate(seperators) if sep < 0]
+        self._seperators = {
+            name: {
+                "input_ids": np.asarray(seps, dtype=TOKEN_DTYPES["input_ids"]),
+                "attention_mask": np.ones(
+                    len(seps), dtype=TOKEN_DTYPES["attention_mask"]
+                ),
+            }
+            for name, seps in [
+                ("prefix", seperators[:question_pos]),
+                ("mid", seperators[question_pos + 1 : context_pos]),
+                ("suffix", seperators[context_pos + 1 :]),
+            ]
+        }
+
+        self.answers_span = pd.read_csv(
+            f"{tokenized_dir}/answers_span.csv",
+            dtype={
+                "question_id": "category",
+                "context_id": "category",
+                "answer_start": np.int32,
+                "answer_end": np.int32,
+            },
+        )
 
         if selected_questions:
             self.answers_span = self.answers_span[
                 self.answers_span.question_id.isin(selected_questions)
             ]
-            questions = {k: v for k, v in questions.items() if k in selected_questions}
 
         context_start = len(self.tokenizer_info["seperators"]) - (
             list(reversed(self.tokenizer_info["seperators"])).index(-1) + 1
         )
-        self.n_seps_before_context = sum(
-            (np.array(self.tokenizer_info["seperators"]) >= 0)[:context_start]
-        )
+        self.n_seps_before_context = sum(sep >= 0 for sep in seperators[:context_start])
 
         subsample_spans = self.generate_subsamples_span()
         self.subsample_spans = resample(subsample_spans, subsample_spans.answer_end > 0)
 
+        self._spans = {
+            col: self.subsample_spans[col].to_numpy()
+            for col in [
+                "subcontext_start",
+                "subcontext_end",
+                "answer_start",
+                "answer_end",
+            ]
+        }
+        self._spans["question_id"] = self.subsample_spans.question_id.to_numpy(object)
+        self._spans["context_id"] = self.subsample_spans.context_id.to_numpy(object)
+        if self._packed:
+            self._index_packed_bounds()
+
     def __getitem__(self, idx: int) -> dict:
         """Gets sample.
 
@@ -86,26 +214,121 @@ class Dataset(torch.utils.data.Dataset):
             dict: Sample.
         """
 
-        instance = self.subsample_spans.iloc[idx, :]
-        question = self._get_instance(instance["question_id"], instance_type="question")
-        context = self._get_instance(instance["context_id"], instance_type="context")
+        question = self._get_instance(
+            self._spans["question_id"][idx], instance_type="question"
+        )
+        context = self._get_instance(
+            self._spans["context_id"][idx], instance_type="context"
+        )
 
+        subcontext_start = self._spans["subcontext_start"][idx]
+        subcontext_end = self._spans["subcontext_end"][idx]
         subcontext = {
-            k: context[k][instance["subcontext_start"] : instance["subcontext_end"] + 1]
+            k: context[k][subcontext_start : subcontext_end + 1]
             for k in ["input_ids", "attention_mask"]
         }
-        subsample = self.combine_qc(question, subcontext)
-        subsample["input_ids"] += [self.tokenizer_info["padding_id"]] * (
-            self.max_length - len(subsample["input_ids"])
+        combined = self.combine_qc(question, subcontext)
+        n_tokens = len(combined["input_ids"])
+
+        subsample = {}
+        for k, fill in [
+            ("input_ids", self.tokenizer_info["padding_id"]),
+            ("attention_mask", 0),
+        ]:
+            padded = np.full(self.max_length, fill, dtype=TOKEN_DTYPES[k])
+            padded[:n_tokens] = combined[k]
+            subsample[k] = torch.from_numpy(padded)
+
+        subsample["start_positions"] = torch.tensor(
+            self._spans["answer_start"][idx], dtype=torch.long
+        )
+        subsample["end_positions"] = torch.tensor(
+            self._spans["answer_end"][idx], dtype=torch.long
+        )
+
+        return subsample
+
+    def __getitems__(self, indices: List[int]) -> List[dict]:
+        """Gets a batch of samples. When the data is packed, the whole batch is gathered from the packed arrays
+        at once instead of combining and padding each sample separately.
+
+        Args:
+            indices (List[int]): Indices of samples.
+
+        Returns:
+            List[dict]: Samples.
+        """
+
+        if not self._packed:
+            return [self[idx] for idx in indices]
+
+        idxs = np.asarray(indices)
+        masks, gather_idxs = self._gather_indices(idxs)
+
+        batch = {}
+        for k, fill in [
+            ("input_ids", self.tokenizer_info["padding_id"]),
+            ("attention_mask", 0),
+        ]:
+            templates = np.concatenate(
+                [
+                    *(seps[k] for seps in self._seperators.values()),
+                    np.asarray([fill], dtype=TOKEN_DTYPES[k]),
+                ]
+            )
+            batch[k] = torch.from_numpy(
+                np.where(
+                    masks["question"],
+                    self._packed["question"][k][gather_idxs["question"]],
+                    np.where(
+                        masks["context"],
+                        self._packed["context"][k][gather_idxs["context"]],
+                        templates[gather_idxs["template"]],
+                    ),
+                )
+            )
+
+        batch["start_positions"] = torch.as_tensor(
+            self._spans["answer_start"][idxs], dtype=torch.long
         )
-        subsample["attention_mask"] += [0] * (
-            self.max_length - len(subsample["attention_mask"])
+        batch["end_positions"] = torch.as_tensor(
+            self._spans["answer_end"][idxs], dtype=torch.long
         )
 
-        subsample["start_positions"] = instance["answer_start"]
-        subsample["end_positions"] = instance["answer_end"]
+        return [{k: v[i] for k, v in batch.items()} for i in range(len(idxs))]
+
+    def __getstate__(self) -> dict:
+        """Gets state for pickling, e.g. when DataLoader sends the dataset to its workers. Packed arrays backed
+        by memory-mapped files or shared memory are left out and re-attached by __setstate__.
+
+        Returns:
+            dict: State.
+        """
+
+        state = self.__dict__.copy()
+        if self._packed:
+            state["_packed"] = {
+                instance_type: (
+                    {"index": packed["index"]}
+                    if instance_type in self._storage.sources
+                    else packed
+                )
+                for instance_type, packed in self._packed.items()
+            }
+
+        return state
+
+    def __setstate__(self, state: dict):
+        """Sets state from unpickling, re-attaching the packed arrays.
 
-        return {key: torch.tensor(val) for key, val in subsample.items()}
+        Args:
+            state (dict): State.
+        """
+
+        self.__dict__.update(state)
+        if self._packed:
+            for instance_type in self._storage.sources:
+                self._packed[instance_type].update(self._storage.attach(instance_type))
 
     def __len__(self) -> int:
         """Returns total number of samples.
@@ -115,59 +338,91 @@ class Dataset(torch.utils.data.Dataset):
         """
         return len(self.subsample_spans)
 
-    def generate_subsample_span(
-        self, question: dict, context: dict, answer_span: Tuple[int, int]
-    ) -> pd.DataFrame:
-        """Generates sample span.
+    def make_loader(
+        self, batch_size: int, num_workers: int = 0, shuffle: bool = True
+    ) -> torch.utils.data.DataLoader:
+        """Creates a DataLoader of this dataset. Workers are kept alive across epochs, and batches are pinned
+        when CUDA is available so that host to device copies can overlap with compute. Data held in memory is
+        moved to shared memory first, so that workers attach to it instead of each receiving a copy.
+
+        Args:
+            batch_size (int): Batch size.
+            num_workers (int, optional): Number of worker processes. Defaults to 0.
+            shuffle (bool, optional): Whether to shuffle samples on every epoch. Defaults to True.
+
+        Returns:
+            torch.utils.data.DataLoader: DataLoader.
+        """
+
+        if num_workers > 0:
+            self._share_packed()
+
+        return torch.utils.data.DataLoader(
+            self,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            num_workers=num_workers,
+            collate_fn=torch.utils.data.default_collate,
+            pin_memory=torch.cuda.is_available(),
+            persistent_workers=num_workers > 0,
+            prefetch_factor=4 if num_workers > 0 else None,
+        )
+
+    def generate_subsample_spans_batch(
+        self,
+        len_question: int,
+        context: dict,
+        answer_spans: np.ndarray,
+        instance_codes: Tuple[int, int],
+    ) -> np.ndarray:
+        """Generates sample spans of all answers of a question-context pair.
 
         Args:
-            question (dict): Dictionary containing information of the question.
+            len_question (int): Number of tokens of the question.
             context (dict): Dictionary containing information of the context.
-            answer_span (Tuple[int, int]): (start_position, end_position).
+            answer_spans (np.ndarray): Array of shape (n_answers, 2) of (start_position, end_position).
+            instance_codes (Tuple[int, int]): (question_code, context_code) of the pair.
 
         Returns:
-            pd.DataFrame: Sample span
+            np.ndarray: Sample spans of shape (n_answers * n_subcontexts, 6) with columns
+                [question_code, context_code, subcontext_start, subcontext_end, answer_start, answer_end].
         """
 
-        len_question = len(question["input_ids"])
-        len_context = len(context["input_ids"])
-        n_seps = sum(np.array(self.tokenizer_info["seperators"]) >= 0)
+        shift = len_question + self.n_seps_before_context
 
-        subcontext_max_length = self.max_length - len_question - n_seps
+        subcontext_max_length = self._max_qc_length - len_question
         stride_ = subcontext_max_length - self.stride
 
-        n_sub = (len_context - self.stride) // stride_ + 1
+        n_sub = (len(context["input_ids"]) - self.stride) // stride_ + 1
 
-        subcontext_spans = (
-            np.repeat([[0, subcontext_max_length - 1]], n_sub, axis=0)
-            + np.ones((n_sub, 2), dtype=int)
-            * stride_
-            * np.array(range(0, n_sub), dtype=int)[:, None]
+        offsets = np.arange(n_sub, dtype=np.int32) * stride_
+        subcontext_spans = np.stack(
+            [offsets, offsets + subcontext_max_length - 1], axis=1
         )
 
-        ans_start, ans_end = answer_span
-        answers_shifted = [
-            [
-                ans_start - context_start + len_question + self.n_seps_before_context,
-                ans_end - context_start + len_question + self.n_seps_before_context,
-            ]
-            if (
-                calculate_overlap(context_start, context_end, ans_start, ans_end + 1)
-                >= min(ans_end - ans_start + 1, self.min_answer_length)
-            )
-            else [0, 0]
-            for context_start, context_end in subcontext_spans
-        ]
-        # answers_shifted = np.array(answers_shifted)
+        ans_starts = answer_spans[:, [0]]
+        ans_ends = answer_spans[:, [1]]
+        context_starts = subcontext_spans[:, 0]
 
-        return pd.DataFrame(
-            np.concatenate([subcontext_spans, answers_shifted], axis=1),
-            columns=[
-                "subcontext_start",
-                "subcontext_end",
-                "answer_start",
-                "answer_end",
+        contain_answer = np.maximum(
+            0,
+            np.minimum(subcontext_spans[:, 1], ans_ends)
+            - np.maximum(context_starts, ans_starts)
+            + 1,
+        ) >= np.minimum(ans_ends - ans_starts + 1, self.min_answer_length)
+
+        return np.concatenate(
+            [
+                np.broadcast_to(instance_codes, (len(answer_spans) * n_sub, 2)),
+                np.tile(subcontext_spans, (len(answer_spans), 1)),
+                np.where(
+                    contain_answer, ans_starts - context_starts + shift, 0
+                ).reshape(-1, 1),
+                np.where(contain_answer, ans_ends - context_starts + shift, 0).reshape(
+                    -1, 1
+                ),
             ],
+            axis=1,
         )
 
     def generate_subsamples_span(self) -> pd.DataFrame:
@@ -177,54 +432,76 @@ class Dataset(torch.utils.data.Dataset):
             pd.DataFrame: Combined samples.
         """
 
+        question_ids = self.answers_span.question_id.cat.categories
+        context_ids = self.answers_span.context_id.cat.categories
+
+        question_lengths = {
+            question_id: len(
+                self._get_instance(question_id, instance_type="question")["input_ids"]
+            )
+            for question_id in self.answers_span.question_id.unique()
+        }
+
+        contexts = self.answers_span.groupby("context_id", sort=False, observed=True)
+
         subsample_spans = []
-        for _, (question_id, context_id, ans_start, ans_end) in tqdm(
-            self.answers_span.iterrows(),
-            total=len(self.answers_span),
-            desc="generating sub-samples spans",
+        for context_id, context_answers in tqdm(
+            contexts, total=contexts.ngroups, desc="generating sub-samples spans"
         ):
             context = self._get_instance(context_id, instance_type="context")
-            question = self._get_instance(question_id, instance_type="question")
 
-            subsample_span = self.generate_subsample_span(
-                question, context, (ans_start, ans_end)
-            )
-            subsample_span.insert(0, "context_id", context_id)
-            subsample_span.insert(0, "question_id", question_id)
+            for question_id, answers in context_answers.groupby(
+                "question_id", sort=False, observed=True
+            ):
+                subsample_spans.append(
+                    self.generate_subsample_spans_batch(
+                        question_lengths[question_id],
+                        context,
+                        answers[["answer_start", "answer_end"]].to_numpy(),
+                        (
+                            question_ids.get_loc(question_id),
+                            context_ids.get_loc(context_id),
+                        ),
+                    )
+                )
 
-            subsample_spans.append(subsample_span)
+        spans = np.concatenate(subsample_spans)
+        result = pd.DataFrame(
+            {
+                "question_id": pd.Categorical.from_codes(spans[:, 0], question_ids),
+                "context_id": pd.Categorical.from_codes(spans[:, 1], context_ids),
+                "subcontext_start": spans[:, 2],
+                "subcontext_end": spans[:, 3],
+                "answer_start": spans[:, 4],
+                "answer_end": spans[:, 5],
+            }
+        )
 
-        return pd.concat(subsample_spans).reset_index(drop=True)
+        return result
 
     def combine_qc(self, question: dict, context: dict) -> dict:
         """Combines a question and a context into 1 content with seperators.
 
         Args:
-            question (dict): Dictionary containing information of the question.
-            context (dict): Dictionary containing information of the context.
+            question (dict): Dictionary containing token arrays of the question.
+            context (dict): Dictionary containing token arrays of the context.
 
         Returns:
             dict: Content.
         """
 
-        result: dict = {k: [] for k in context.keys()}
-        content = [question, context]
-
-        for sep in self.tokenizer_info["seperators"]:
-            if sep >= 0:
-                sep_dict = {
-                    "input_ids": sep,
-                    "attention_mask": 1,
-                    "offset_mapping": (0, 0),
-                    "sequence_ids": None,
-                }
-                result = {k: v + [sep_dict[k]] for k, v in result.items()}
-
-            else:
-                instance = content.pop(0)
-                result = {k: v + instance[k] for k, v in result.items()}
-
-        return result
+        return {
+            k: np.concatenate(
+                [
+                    self._seperators["prefix"][k],
+                    question[k],
+                    self._seperators["mid"][k],
+                    context[k],
+                    self._seperators["suffix"][k],
+                ]
+            )
+            for k in ["input_ids", "attention_mask"]
+        }
 
     def _get_instance(self, idenifier: Union[int, str], instance_type: str) -> dict:
         """Gets instance.
@@ -234,7 +511,7 @@ class Dataset(torch.utils.data.Dataset):
             instance_type (str): Instance type. Either "question" or "context".
 
         Returns:
-            dict: Instance.
+            dict: Instance, with "input_ids" and "attention_mask" as arrays.
         """
 
         assert instance_type in (
@@ -242,8 +519,219 @@ class Dataset(torch.utils.data.Dataset):
             "context",
         ), 'instance_type must be either "question" or "context".'
 
-        return (
-            self.content[instance_type][idenifier]
-            if self.content
-            else read_pickle(f"{self.tokenized_dir}/{instance_type}/{idenifier}.pickle")
+        if self._packed:
+            packed = self._packed[instance_type]
+            offset, length = packed["index"][idenifier]
+            return {
+                k: packed[k][offset : offset + length]
+                for k in ["input_ids", "attention_mask"]
+            }
+
+        return self._to_arrays(
+            read_pickle(f"{self.tokenized_dir}/{instance_type}/{idenifier}.pickle")
+        )
+
+    def _load_packed(self, instance_type: str) -> dict:
+        """Memory-maps the packed arrays of an instance type (from Preparer.compile_mmap).
+
+        Args:
+            instance_type (str): Instance type. Either "question" or "context".
+
+        Returns:
+            dict: "input_ids" and "attention_mask" arrays, and "index" mapping instance ID to (offset, length).
+        """
+
+        path = f"{self.tokenized_dir}/{instance_type}s"
+        self._storage.sources[instance_type] = {
+            "input_ids": f"{path}.ids.npy",
+            "attention_mask": f"{path}.mask.npy",
+        }
+
+        return {
+            **self._storage.attach(instance_type),
+            "index": self._read_index(np.load(f"{path}.index.npy")),
+        }
+
+    def _index_packed_bounds(self):
+        """Adds the offset and length of each sample's question and context in the packed arrays to the
+        sample spans, so that batches are gathered without looking up the packed indexes.
+        """
+
+        for prefix, instance_type in [("q", "question"), ("c", "context")]:
+            index = self._packed[instance_type]["index"]
+            offsets, lengths = (
+                np.array(
+                    [index[i] for i in self._spans[f"{instance_type}_id"]],
+                    dtype=np.int64,
+                )
+                .reshape(-1, 2)
+                .T
+            )
+            self._spans[f"{prefix}_offset"] = offsets
+            self._spans[f"{prefix}_length"] = lengths
+
+    def _gather_indices(self, idxs: np.ndarray) -> Tuple[dict, dict]:
+        """Locates every token of a batch of samples in the packed arrays and the separator templates.
+
+        Args:
+            idxs (np.ndarray): Indices of samples.
+
+        Returns:
+            Tuple[dict, dict]: "question" and "context" masks of the tokens taken from the packed arrays, and
+                "question", "context", and "template" indices to gather the tokens from, each of shape
+                (n_samples, max_length).
+        """
+
+        q_lengths = self._spans["q_length"][idxs, None]
+        subcontext_starts = self._spans["subcontext_start"][idxs, None]
+        subcontext_lengths = np.clip(
+            np.minimum(
+                self._spans["subcontext_end"][idxs, None] + 1,
+                self._spans["c_length"][idxs, None],
+            )
+            - subcontext_starts,
+            0,
+            None,
+        )
+
+        n_prefix, n_mid, n_suffix = (
+            len(seps["input_ids"]) for seps in self._seperators.values()
+        )
+
+        cols = np.arange(self.max_length)[None, :]
+        c_begin = n_prefix + q_lengths + n_mid
+        s_begin = c_begin + subcontext_lengths
+
+        masks = {
+            "question": (cols >= n_prefix) & (cols < n_prefix + q_lengths),
+            "context": (cols >= c_begin) & (cols < s_begin),
+        }
+
+        # positions in the concatenated [prefix, mid, suffix, padding] templates,
+        # with the last element (padding) filling everything after the suffix.
+        template_idxs = np.select(
+            [
+                cols < n_prefix,
+                (cols >= n_prefix + q_lengths) & (cols < c_begin),
+                (cols >= s_begin) & (cols < s_begin + n_suffix),
+            ],
+            [cols, cols - q_lengths, cols - s_begin + n_prefix + n_mid],
+            n_prefix + n_mid + n_suffix,
+        )
+
+        return masks, {
+            "question": np.where(
+                masks["question"],
+                self._spans["q_offset"][idxs, None] + cols - n_prefix,
+                0,
+            ),
+            "context": np.where(
+                masks["context"],
+                self._spans["c_offset"][idxs, None]
+                + subcontext_starts
+                + cols
+                - c_begin,
+                0,
+            ),
+            "template": template_idxs,
+        }
+
+    def _pack(self, instance_type: str) -> dict:
+        """Reads the tokenized pickles of an instance type and packs them into arrays in memory.
+
+        Args:
+            instance_type (str): Instance type. Either "question" or "context".
+
+        Returns:
+            dict: "input_ids" and "attention_mask" arrays, and "index" mapping instance ID to (offset, length).
+        """
+
+        input_ids, attention_mask, index = pack_instances(
+            read_instances(
+                f"{self.tokenized_dir}/{instance_type}",
+                desc=f"loading {instance_type}s",
+            )
+        )
+
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "index": self._read_index(index),
+        }
+
+    def _share_packed(self):
+        """Moves packed arrays held in memory into shared memory. They are left in memory, and copied to each
+        DataLoader worker instead, when there is not enough shared memory for them.
+        """
+
+        in_memory = [t for t in self._packed or {} if t not in self._storage.sources]
+        arrays = [
+            (t, k, self._packed[t][k])
+            for t in in_memory
+            for k in ["input_ids", "attention_mask"]
+        ]
+        if not arrays:
+            return
+        nbytes = sum(array.nbytes for _, _, array in arrays)
+
+        # creating a block larger than the free space of /dev/shm does not fail, but writing to it
+        # kills the process with SIGBUS.
+        blocks: List[shared_memory.SharedMemory] = []
+        try:
+            if (
+                os.path.isdir("/dev/shm")
+                and shutil.disk_usage("/dev/shm").free < nbytes
+            ):
+                raise OSError(f"less than {nbytes} bytes free in /dev/shm")
+            for _, _, array in arrays:
+                blocks.append(
+                    shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                )
+        except OSError as error:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+            warnings.warn(
+                f"Not enough shared memory ({error}), so every DataLoader worker "
+                "receives a copy of the dataset instead."
+            )
+            return
+
+        for (instance_type, k, array), shm in zip(arrays, blocks):
+            self._packed[instance_type][k] = self._storage.share(
+                instance_type, k, array, shm
+            )
+
+    @staticmethod
+    def _read_index(index: np.ndarray) -> dict:
+        """Converts a packed index (from pack_instances) to a dictionary.
+
+        Args:
+            index (np.ndarray): Structured array with "id", "offset", and "length" fields.
+
+        Returns:
+            dict: Dictionary mapping instance ID to (offset, length).
+        """
+
+        return dict(
+            zip(
+                index["id"].tolist(),
+                zip(index["offset"].tolist(), index["length"].tolist()),
+            )
         )
+
+    @staticmethod
+    def _to_arrays(instance: dict) -> dict:
+        """Converts token lists of an instance into arrays.
+
+        Args:
+            instance (dict): Dictionary containing tokenized information of the instance (from Preparer).
+
+        Returns:
+            dict: Dictionary containing "input_ids" and "attention_mask" arrays.
+        """
+
+        return {
+            k: np.asarray(instance[k], dtype=TOKEN_DTYPES[k])
+            for k in ["input_ids", "attention_mask"]
+        }
@@ -9,7 +9,12 @@ from transformers import AutoTokenizer
 from transformers.utils import logging
 
 from src.libs.utils import read_pickle, save_json, save_pickle
-from src.preprocessing.utils import get_answer_span, read_squad
+from src.preprocessing.utils import (
+    get_answer_span,
+    pack_instances,
+    read_instances,
+    read_squad,
+)
 
 
 class Preparer:
@@ -139,6 +144,21 @@ class Preparer:
                 encode_dict, f"{self.out_dir}/{instance_type}/{instance_id}.pickle"
             )
 
+    def compile_mmap(self):
+        """Packs the tokenized pickles of each instance type into contiguous .npy files, which can be
+        memory-mapped by Dataset instead of reading the pickles one by one.
+        """
+
+        for instance_type in ["question", "context"]:
+            instances = read_instances(
+                f"{self.out_dir}/{instance_type}", desc=f"compiling {instance_type}s"
+            )
+            input_ids, attention_mask, index = pack_instances(instances)
+
+            np.save(f"{self.out_dir}/{instance_type}s.ids.npy", input_ids)
+            np.save(f"{self.out_dir}/{instance_type}s.mask.npy", attention_mask)
+            np.save(f"{self.out_dir}/{instance_type}s.index.npy", index)
+
     def get_tokenizer_info(self):
         """Gets and saves tokenizer information."""
 
@@ -1,8 +1,15 @@
-from typing import Tuple
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
 
+import numpy as np
 import pandas as pd
+from tqdm import tqdm
 
-from src.libs.utils import read_json
+from src.libs.utils import read_json, read_pickle
+
+# Token IDs fit in int32 for any vocabulary, and attention masks are binary.
+TOKEN_DTYPES = {"input_ids": np.int32, "attention_mask": np.uint8}
 
 
 def read_squad(path: str) -> pd.DataFrame:
@@ -100,6 +107,71 @@ def calculate_overlap(x_start: int, x_end: int, y_start: int, y_end: int) -> int
     return max(0, min(x_end, y_end) - max(x_start, y_start))
 
 
+def read_instances(directory: str, desc: Optional[str] = None) -> Dict[str, dict]:
+    """Reads all tokenized instances (pickle files) in a directory. Files are read by a thread pool, so that
+    disk reads overlap with unpickling.
+
+    Args:
+        directory (str): Directory containing the pickle files.
+        desc (Optional[str], optional): Description of the progress bar. Defaults to None.
+
+    Returns:
+        Dict[str, dict]: Dictionary mapping instance ID (file name without extension) to the instance.
+    """
+
+    files = os.listdir(directory)
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2)) as executor:
+        instances = list(
+            tqdm(
+                executor.map(lambda f: read_pickle(f"{directory}/{f}"), files),
+                total=len(files),
+                desc=desc,
+            )
+        )
+
+    return {os.path.splitext(f)[0]: instance for f, instance in zip(files, instances)}
+
+
+def pack_instances(
+    instances: Dict[str, dict],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Packs tokenized instances into contiguous arrays, so that each instance can be retrieved as a slice of them.
+
+    Args:
+        instances (Dict[str, dict]): Dictionary mapping instance ID to its tokenized information, with
+            "input_ids" and "attention_mask" keys.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: (input_ids, attention_mask, index), where index is a structured
+            array with "id", "offset", and "length" fields locating each instance in the packed arrays.
+    """
+
+    ids = list(instances.keys())
+    lengths = np.array([len(instances[i]["input_ids"]) for i in ids], dtype=np.int32)
+    offsets = np.cumsum(lengths, dtype=np.int64) - lengths
+
+    index = np.empty(
+        len(ids),
+        dtype=[
+            ("id", np.array(ids).dtype),
+            ("offset", np.int64),
+            ("length", np.int32),
+        ],
+    )
+    index["id"] = ids
+    index["offset"] = offsets
+    index["length"] = lengths
+
+    input_ids, attention_mask = (
+        np.concatenate(
+            [np.asarray(instances[i][k], dtype=TOKEN_DTYPES[k]) for i in ids]
+        )
+        for k in ["input_ids", "attention_mask"]
+    )
+
+    return input_ids, attention_mask, index
+
+
 def resample(data: pd.DataFrame, contain_answer: pd.Series) -> pd.DataFrame:
     """Resample data such that the numbers of positive samples (the sample contain the answer to the question), and
     negative samples (the sample does not contain the answer to the question), are equal.
@@ -112,7 +184,12 @@ def resample(data: pd.DataFrame, contain_answer: pd.Series) -> pd.DataFrame:
         pd.DataFrame: Resampled data.
     """
 
-    negative = data[~contain_answer].sample(sum(contain_answer), random_state=2023)
-    positive = data[contain_answer]
+    contain_answer = np.asarray(contain_answer)
+    positive = np.flatnonzero(contain_answer)
+    negative = (
+        pd.Series(np.flatnonzero(~contain_answer))
+        .sample(len(positive), random_state=2023)
+        .to_numpy()
+    )
 
-    return pd.concat([positive, negative])
+    return data.iloc[np.concatenate([positive, negative])]
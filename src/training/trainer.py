@@ -1,7 +1,6 @@
 from typing import Callable
 
 import torch
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 from transformers import AutoModelForQuestionAnswering
 
@@ -18,6 +17,7 @@ class Trainer:
         batch_size: int,
         learning_rate: float,
         epochs: int,
+        num_workers: int = 0,
     ) -> None:
         """Trainer class
 
@@ -27,6 +27,7 @@ class Trainer:
             batch_size (int): Batch size.
             learning_rate (float): Learning rate for the optimizer.
             epochs (int): Number of epochs for training.
+            num_workers (int, optional): Number of DataLoader worker processes. Defaults to 0.
         """
 
         self.model = model
@@ -34,6 +35,7 @@ class Trainer:
         self.batch_size = batch_size
         self.learning_rate = learning_rate
         self.epochs = epochs
+        self.num_workers = num_workers
 
         if torch.cuda.is_available():
             self.device = torch.device("cuda")
@@ -54,17 +56,25 @@ class Trainer:
             data (Dataset): Training data.
         """
 
-        data_loader = DataLoader(data, batch_size=self.batch_size, shuffle=True)
+        data_loader = data.make_loader(self.batch_size, num_workers=self.num_workers)
 
         for epoch in range(3):
             for batch in tqdm(
                 data_loader, total=len(data_loader), desc=f"epoch {epoch}"
             ):
                 self.optim.zero_grad()
-                input_ids = batch["input_ids"].to(self.device)
-                attention_mask = batch["attention_mask"].to(self.device)
-                start_positions = batch["start_positions"].to(self.device)
-                end_positions = batch["end_positions"].to(self.device)
+                # token tensors are int32/uint8 on the host to keep batches small,
+                # and are cast once they are on the device.
+                input_ids = batch["input_ids"].to(self.device, non_blocking=True).long()
+                attention_mask = (
+                    batch["attention_mask"].to(self.device, non_blocking=True).long()
+                )
+                start_positions = batch["start_positions"].to(
+                    self.device, non_blocking=True
+                )
+                end_positions = batch["end_positions"].to(
+                    self.device, non_blocking=True
+                )
                 outputs = self.model(
                     input_ids,
                     attention_mask=attention_mask,
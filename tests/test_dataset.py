@@ -0,0 +1,185 @@
+import copy
+import gc
+import glob
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from src.libs.utils import save_json, save_pickle
+from src.preprocessing.dataset import Dataset
+from src.preprocessing.preparer import Preparer
+from src.preprocessing.utils import read_instances
+
+MAX_LENGTH = 64
+STRIDE = 16
+QUESTION_LENGTHS = {"Q0": 5, "Q1": 9, "123": 3}
+# with 4 separators, the last sub-context of every context runs past its end.
+CONTEXT_LENGTHS = {"contract 0": 100, "contract 1": 150, "7": 60}
+
+requires_dev_shm = pytest.mark.skipif(
+    not os.path.isdir("/dev/shm"),
+    reason="shared memory blocks are not listed in /dev/shm",
+)
+
+
+def make_instance(rng: np.random.Generator, length: int) -> dict:
+    """Makes a tokenized instance with random input IDs."""
+    return {
+        "input_ids": rng.integers(5, 30000, length).tolist(),
+        "attention_mask": [1] * length,
+        "offset_mapping": [(0, 0)] * length,
+        "sequence_ids": [0] * length,
+    }
+
+
+@pytest.fixture(name="tokenized_dir")
+def fixture_tokenized_dir(tmp_path) -> str:
+    """Makes a small tokenized directory, as written by Preparer."""
+    rng = np.random.default_rng(2023)
+    os.makedirs(tmp_path / "question")
+    os.makedirs(tmp_path / "context")
+
+    for question_id, length in QUESTION_LENGTHS.items():
+        save_pickle(
+            make_instance(rng, length), f"{tmp_path}/question/{question_id}.pickle"
+        )
+
+    rows = []
+    for context_id, length in CONTEXT_LENGTHS.items():
+        save_pickle(
+            make_instance(rng, length), f"{tmp_path}/context/{context_id}.pickle"
+        )
+        for question_id in QUESTION_LENGTHS:
+            rows.append((question_id, context_id, 0, 0))
+            rows.append((question_id, context_id, length - 3, length - 1))
+
+    pd.DataFrame(
+        rows, columns=["question_id", "context_id", "answer_start", "answer_end"]
+    ).to_csv(f"{tmp_path}/answers_span.csv", index=False)
+    save_json(
+        {"seperators": [0, -1, 2, 2, -1, 2], "padding_id": 1},
+        f"{tmp_path}/tokenizer_info.json",
+    )
+
+    return str(tmp_path)
+
+
+def compile_mmap(tokenized_dir: str):
+    """Runs Preparer.compile_mmap on a tokenized directory, without loading a tokenizer."""
+    preparer = Preparer.__new__(Preparer)
+    preparer.out_dir = tokenized_dir
+    preparer.compile_mmap()
+
+
+@pytest.mark.parametrize("mode", ["memory", "mmap", "disk"])
+def test_getitems_matches_getitem(tokenized_dir, mode):
+    if mode == "mmap":
+        compile_mmap(tokenized_dir)
+    dataset = Dataset(
+        tokenized_dir, MAX_LENGTH, STRIDE, 1, save_to_memory=mode != "disk"
+    )
+
+    context_lengths = np.array(
+        [CONTEXT_LENGTHS[i] for i in dataset.subsample_spans.context_id]
+    )
+    assert (dataset.subsample_spans.subcontext_end.to_numpy() >= context_lengths).any()
+
+    indices = list(range(len(dataset)))
+    batch = dataset.__getitems__(indices)
+
+    assert len(batch) == len(indices)
+    for idx, sample in zip(indices, batch):
+        expected = dataset[idx]
+        assert sample.keys() == expected.keys()
+        for k, value in expected.items():
+            assert sample[k].dtype == value.dtype
+            assert torch.equal(sample[k], value)
+
+
+def test_compiled_instances_match_pickles(tokenized_dir):
+    compile_mmap(tokenized_dir)
+    dataset = Dataset(tokenized_dir, MAX_LENGTH, STRIDE, 1)
+
+    for instance_type in ["question", "context"]:
+        path = f"{tokenized_dir}/{instance_type}s"
+        index = np.load(f"{path}.index.npy")
+        arrays = {
+            "input_ids": np.load(f"{path}.ids.npy", mmap_mode="r"),
+            "attention_mask": np.load(f"{path}.mask.npy", mmap_mode="r"),
+        }
+        instances = read_instances(f"{tokenized_dir}/{instance_type}")
+
+        assert index["id"].dtype.kind == "U"
+        assert sorted(index["id"]) == sorted(instances)
+        for identifier, offset, length in index:
+            instance = instances[identifier]
+            # pylint: disable-next=protected-access
+            packed = dataset._get_instance(identifier, instance_type=instance_type)
+            for k, array in arrays.items():
+                assert array[offset : offset + length].tolist() == instance[k]
+                assert packed[k].tolist() == instance[k]
+
+
+def shared_blocks() -> set:
+    """Lists the shared memory blocks created by multiprocessing.shared_memory."""
+    return set(glob.glob("/dev/shm/psm_*"))
+
+
+def samples(dataset: Dataset) -> dict:
+    """Stacks every sample of a dataset, fetched one by one."""
+    items = [dataset[idx] for idx in range(len(dataset))]
+    return {k: torch.stack([item[k] for item in items]) for k in items[0]}
+
+
+@requires_dev_shm
+def test_copies_do_not_unlink_shared_memory(tokenized_dir):
+    before = shared_blocks()
+    dataset = Dataset(tokenized_dir, MAX_LENGTH, STRIDE, 1)
+    expected = samples(dataset)
+    loader = dataset.make_loader(4, num_workers=1, shuffle=False)
+    blocks = shared_blocks() - before
+    assert blocks
+
+    for make_copy in [
+        lambda: pickle.loads(pickle.dumps(dataset)),
+        lambda: copy.deepcopy(dataset),
+    ]:
+        dataset_copy = make_copy()
+        del dataset_copy
+        gc.collect()
+
+        assert blocks <= shared_blocks()
+        for k, value in samples(dataset).items():
+            assert torch.equal(value, expected[k])
+
+    del loader
+
+
+@requires_dev_shm
+def test_shared_memory_unlinked_with_dataset(tokenized_dir):
+    before = shared_blocks()
+    dataset = Dataset(tokenized_dir, MAX_LENGTH, STRIDE, 1)
+    assert shared_blocks() == before
+
+    loader = dataset.make_loader(4, num_workers=1, shuffle=False)
+    blocks = shared_blocks() - before
+    assert blocks
+
+    del loader, dataset
+    gc.collect()
+
+    assert not blocks & shared_blocks()
+
+
+def test_loader_matches_getitem(tokenized_dir):
+    dataset = Dataset(tokenized_dir, MAX_LENGTH, STRIDE, 1)
+    expected = samples(dataset)
+
+    batches = list(dataset.make_loader(4, num_workers=1, shuffle=False))
+
+    for k, value in expected.items():
+        assert torch.equal(torch.cat([batch[k] for batch in batches]), value)